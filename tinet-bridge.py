@@ -3,13 +3,21 @@ import sys
 import os
 import dotenv
 import threading
+import selectors
 from colorama import init, Fore
 import signal
 import serial
-import serial.threaded
 import time
+import random
 from serial.tools import list_ports
 import logging
+import logging.handlers
+import argparse
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
 
 init(autoreset=True)
 
@@ -21,32 +29,113 @@ SERIAL = True
 DEBUG = True
 MANUAL_PORT = False
 ENABLE_RECONNECT = True
+SERIAL_BATCH_DELAY = 0.001  # seconds to wait for the rest of a message
+SERIAL_BATCH_SIZE = 4096
 # -------END CONFIG------- #
 
-logging.basicConfig(filename=f"log-{round(time.time())}.log",
-                    filemode='a',
-                    format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-                    datefmt='%H:%M:%S',
-                    level=logging.DEBUG)
-
 logger = logging.getLogger()
 
-CALC_ID = dotenv.get_key(key_to_get="CALC_ID", dotenv_path=".env")
-USERNAME = dotenv.get_key(key_to_get="USERNAME", dotenv_path=".env")
-TOKEN = dotenv.get_key(key_to_get="TOKEN", dotenv_path=".env")
+MSG_BRIDGE_CONNECTED = b"bridgeConnected\0"
+MSG_INTERNET_DISCONNECTED = b"internetDisconnected"
+MSG_SERIAL_CONNECTED = b"SERIAL_CONNECTED"
+MSG_DISCONNECT = b"DISCONNECT"
+
+env = dotenv.dotenv_values(".env")
+CALC_ID = env.get("CALC_ID")
+USERNAME = env.get("USERNAME")
+TOKEN = env.get("TOKEN")
 
 if CALC_ID is None or USERNAME is None or TOKEN is None:
     print(Fore.RED + "calc ID, username or token could not be loaded from .env!")
 
 
+def is_calculator_port(port):
+    return "USB Serial Device" in port.description or "TI-84" in port.description
+
+
+def scan_serial_port():
+    """Return the calculator's port if it is connected right now, otherwise None"""
+    for port in list_ports.comports():
+        if is_calculator_port(port):
+            return port
+    return None
+
+
 def find_serial_port():
+    monitor = None
+    if pyudev is not None and sys.platform.startswith("linux"):
+        try:
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            monitor.filter_by('tty')
+            # start listening before checking present devices so a plug-in in between is not missed
+            monitor.start()
+        except (ImportError, OSError) as e:
+            logger.debug("udev monitor unavailable, polling instead: %s", e)
+            monitor = None
+
+    if monitor is not None:
+        try:
+            return wait_for_serial_port(monitor)
+        except OSError as e:
+            logger.debug("udev monitor failed, polling instead: %s", e)
+        finally:
+            # pyudev has no close(), dropping the last reference closes the netlink socket
+            del monitor
+
     while True:
         time.sleep(1)
-        ports = list(serial.tools.list_ports.comports())
-        for port in ports:
-            if "USB Serial Device" in port.description or "TI-84" in port.description:
-                return port
-        
+        port = scan_serial_port()
+        if port is not None:
+            return port
+
+
+def wait_for_serial_port(monitor):
+    """Wait on udev tty hotplug events until a calculator shows up (Linux only)"""
+    from serial.tools.list_ports_linux import SysFS
+
+    port = scan_serial_port()
+    while port is None:
+        device = monitor.poll(timeout=1)
+        if device is None:
+            # without a running udevd no events arrive, so rescan like the polling loop does
+            port = scan_serial_port()
+        elif device.action == "add" and device.device_node is not None:
+            candidate = SysFS(device.device_node)
+            if is_calculator_port(candidate):
+                port = candidate
+    return port
+
+
+def enable_low_latency(serial_instance):
+    """Ask the USB-serial driver to skip its latency timer (Linux only)"""
+    if not sys.platform.startswith("linux"):
+        return
+    import fcntl
+    import struct
+
+    TIOCGSERIAL = 0x541E
+    TIOCSSERIAL = 0x541F
+    ASYNC_LOW_LATENCY = 0x2000
+    # serial_struct: type, line, port, irq, flags, ...
+    FLAGS_OFFSET = 16
+
+    try:
+        buf = bytearray(128)
+        fcntl.ioctl(serial_instance.fd, TIOCGSERIAL, buf)
+        flags = struct.unpack_from("i", buf, FLAGS_OFFSET)[0] | ASYNC_LOW_LATENCY
+        struct.pack_into("i", buf, FLAGS_OFFSET, flags)
+        fcntl.ioctl(serial_instance.fd, TIOCSSERIAL, buf)
+        return
+    except (AttributeError, OSError) as e:
+        logger.debug("ASYNC_LOW_LATENCY not applied: %s", e)
+
+    tty = os.path.basename(serial_instance.port)
+    try:
+        with open(f"/sys/bus/usb-serial/devices/{tty}/latency_timer", "w") as latency_timer:
+            latency_timer.write("1")
+    except OSError as e:
+        logger.debug("latency_timer not applied: %s", e)
+
 
 class SocketThread(threading.Thread):
     """Manages server connection"""
@@ -56,67 +145,104 @@ class SocketThread(threading.Thread):
         self.alive = False
         self.socket = None
         self.serial_manager = None
-        self._lock = threading.Lock()
+        self._serial_ready = threading.Event()
+        self._rxbuf = bytearray(65536)
+        self._rxmv = memoryview(self._rxbuf)
+
+    def set_serial_manager(self, serial_manager):
+        """Attach the serial manager and wake up the reader loop"""
+        self.serial_manager = serial_manager
+        self._serial_ready.set()
     
-    def stop(self):
+    def _shutdown(self):
+        """Stop the reader loop, notify the calculator and wake up the selector"""
         self.alive = False
 
         if self.serial_manager.alive:
-            self.serial_manager.write("internetDisconnected".encode())
-            print("Notified client bridge got disconnected!")
-        
-        self.socket.close()
-        self.join()
+            try:
+                self.serial_manager.write(MSG_INTERNET_DISCONNECTED)
+                print("Notified client bridge got disconnected!")
+            except (serial.SerialException, OSError) as e:
+                # the calculator may be in the middle of reconnecting
+                logger.error("Could not notify client: %s", e)
+
+        if self.socket is None:
+            return
+        # close() alone does not wake up select(), the reader closes the socket on its way out
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def stop(self):
+        self._shutdown()
+        if threading.current_thread() is not self:
+            self.join()
 
     def run(self):
-        while self.serial_manager is None:
-            pass
+        self._serial_ready.wait()
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # set before connect so the window scale is negotiated for the larger buffer
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
 
         print("Creating TCP socket...")
+        # only bound the connect, the reader loop below blocks in select()
         self.socket.settimeout(10)
 
         print("Connecting to TCP socket...")
         # try:
         self.socket.connect((SERVER_ADDRESS, SERVER_PORT))
+        self.socket.settimeout(None)
         self.alive = True
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
        
-        self.serial_manager.write("bridgeConnected\0".encode())
+        self.serial_manager.write(MSG_BRIDGE_CONNECTED)
         print("Client got notified he was connected to the bridge!")
 
         while self.alive:
-            server_response = bytes()
             try:
-                server_response = self.socket.recv(4096)
-            except socket.timeout:
-                continue
+                selector.select()
+                if not self.alive:
+                    break
+                received = self.socket.recv_into(self._rxmv)
             except Exception as e:
                 print(f"Error: {e}")
-                self.stop()
-
-            if server_response is None or server_response == b"":
-                logging.error(server_response)
-                self.stop()
-            decoded_server_response = server_response.decode()
-            logging.debug(decoded_server_response)
+                self._shutdown()
+                break
 
+            if received == 0:
+                logger.error("Server closed the connection")
+                self._shutdown()
+                break
+            # view into the receive buffer, only valid until the next recv_into
+            server_response = self._rxmv[:received]
+            if DEBUG or logger.isEnabledFor(logging.DEBUG):
+                decoded_server_response = str(server_response, 'utf-8', errors='replace')
+                logger.debug("%s", decoded_server_response)
             if DEBUG:
-                print(f'R - server - ED: {server_response}')
-            print(f'R - server: {decoded_server_response}')
+                print(f'R - server - ED: {server_response.tobytes()}')
+                print(f'R - server: {decoded_server_response}')
 
             if self.serial_manager.alive:
-                self.serial_manager.write(decoded_server_response.encode())
-            
-            print(f'W - serial: {decoded_server_response}')
+                self.serial_manager.write(server_response)
 
-            if decoded_server_response == "DISCONNECT":
+            if DEBUG:
+                print(f'W - serial: {decoded_server_response}')
+
+            if server_response == MSG_DISCONNECT:
                 self.alive = False
 
+        selector.close()
+        self.socket.close()
+
     def write(self, data):
-        """Thread safe writing (uses lock)"""
-        with self._lock:
-            return self.socket.send(data)
+        """Send all of data to the server"""
+        self.socket.sendall(data)
 
 
 class SerialThread(threading.Thread):
@@ -132,14 +258,11 @@ class SerialThread(threading.Thread):
         super(SerialThread, self).__init__()
         self.daemon = True
         self.serial_port = serial_port
-        if MANUAL_PORT:
-            self.serial = serial.Serial(self.serial_port, baudrate=9600, timeout=3)
-        else:
-            self.serial = serial.Serial(find_serial_port().device, baudrate=9600, timeout=3)
+        self.serial = serial.Serial(self.serial_port, baudrate=9600, timeout=3)
+        enable_low_latency(self.serial)
         self.socket_manager = None
         self.alive = True
         self._lock = threading.Lock()
-        self._connection_made = threading.Event()
 
     def stop(self):
         """Stop the reader thread"""
@@ -151,43 +274,85 @@ class SerialThread(threading.Thread):
     def run(self):
         """Reader loop"""
         
+        pending = bytearray()
         while self.alive and self.serial.is_open:
             try:
-                # read all that is there or wait for one byte (blocking)
-                data = self.serial.read(self.serial.in_waiting)
+                if b"\0" not in pending:
+                    # wait for one byte (blocking), then read until the end of the message
+                    first = self.serial.read(1)
+                    if not first and not pending:
+                        continue
+                    pending += first
+                    # coalesce the rest of the message so it goes out in one send
+                    while first and b"\0" not in pending and len(pending) < SERIAL_BATCH_SIZE:
+                        extra = self.serial.in_waiting
+                        if not extra:
+                            time.sleep(SERIAL_BATCH_DELAY)
+                            extra = self.serial.in_waiting
+                            if not extra:
+                                break
+                        pending += self.serial.read(min(extra, SERIAL_BATCH_SIZE - len(pending)))
+                # the calculator terminates each message with \0, forward them one by one
+                data, _, pending = pending.partition(b"\0")
             except Exception as e:
+                pending = bytearray()
                 print(f"Error: {e}")
                 if ENABLE_RECONNECT:
                     print("Trying to reconnect...")
 
-                    while True:
-                        time.sleep(1)
+                    # release the unplugged tty so the calculator can come back on the same one
+                    try:
+                        self.serial.close()
+                    except Exception:
+                        pass
+
+                    delay = 0.1
+                    port_present = True
+                    while self.alive:
+                        time.sleep(delay + random.random() * 0.05)
+                        delay = min(delay * 2, 5.0)
                         try:
-                            if MANUAL_PORT:
-                                self.serial = serial.Serial(self.serial_port, baudrate=9600, timeout=3)
-                            else:
-                                self.serial = serial.Serial(find_serial_port().device, baudrate=9600, timeout=3)
-                            self.write("bridgeConnected\0".encode())
-                            print("Reconnected!")
-                            break
+                            self.serial = serial.Serial(self.serial_port, baudrate=9600, timeout=3)
                         except Exception:
                             pass
+                        else:
+                            try:
+                                enable_low_latency(self.serial)
+                                self.write(MSG_BRIDGE_CONNECTED)
+                                print("Reconnected!")
+                                break
+                            except Exception:
+                                self.serial.close()
+
+                        # the calculator may have come back on another port
+                        if not MANUAL_PORT:
+                            try:
+                                port = scan_serial_port()
+                            except Exception as e:
+                                logger.debug("Serial port scan failed: %s", e)
+                            else:
+                                if port is not None and (not port_present or port.device != self.serial_port):
+                                    # the calculator just came back, retry right away
+                                    self.serial_port = port.device
+                                    delay = 0.1
+                                port_present = port is not None
                 else:
                     self.alive = False
                     pass
             else:
+                data = bytes(data.replace(b"/0", b""))
                 if data:
-                    if data is None or data == b"":
-                        logging.error("Data issue")
-                    # make a separated try-except for called user code
-                    decoded_data = data.decode().replace("/0", "").replace("\0", "")
-                    logging.debug(decoded_data)
+                    if DEBUG or logger.isEnabledFor(logging.DEBUG):
+                        decoded_data = data.decode('utf-8', errors='replace')
+                        logger.debug("%s", decoded_data)
                     if DEBUG:
                         print(f'R - serial - ED: {data}')
-                    print(f'R - serial: {decoded_data}')
+                        print(f'R - serial: {decoded_data}')
+
+                    self.socket_manager.write(data)
 
-                    self.socket_manager.write(decoded_data.encode())
-                    print(f'W - server: {decoded_data}')
+                    if DEBUG:
+                        print(f'W - server: {decoded_data}')
 
         self.alive = False
 
@@ -197,42 +362,10 @@ class SerialThread(threading.Thread):
             return self.serial.write(data)
 
     def close(self):
-        """Close the serial port and exit reader thread (uses lock)"""
-        # use the lock to let other threads finish writing
-        with self._lock:
-            # first stop reading, so that closing can be done on idle port
-            self.stop()
-            self.serial.close()
-
-    def connect(self):
-        """
-        Wait until connection is set up and return the transport and protocol
-        instances.
-        """
-        if self.alive:
-            self._connection_made.wait()
-            if not self.alive:
-                raise RuntimeError('connection_lost already called')
-            return (self, self.protocol)
-        else:
-            raise RuntimeError('already stopped')
-
-    # - -  context manager, returns protocol
-
-    def __enter__(self):
-        """\
-        Enter context handler. May raise RuntimeError in case the connection
-        could not be created.
-        """
-        self.start()
-        self._connection_made.wait()
-        if not self.alive:
-            raise RuntimeError('connection_lost already called')
-        return self.protocol
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        """Leave context: close port"""
-        self.close()
+        """Close the serial port and exit reader thread"""
+        # first stop reading, so that closing can be done on idle port
+        self.stop()
+        self.serial.close()
 
 
 def receive_response(sock):
@@ -297,6 +430,16 @@ def select_serial_port():
 
 
 def main():
+    parser = argparse.ArgumentParser(description="TI-84 Plus CE Net Bridge")
+    parser.add_argument("--debug", action="store_true", help="log forwarded data to the log file")
+    args = parser.parse_args()
+
+    log_handler = logging.handlers.RotatingFileHandler("tinet-bridge.log", maxBytes=1 << 20, backupCount=3)
+    log_handler.setFormatter(logging.Formatter('%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+                                               datefmt='%H:%M:%S'))
+    logger.addHandler(log_handler)
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
     if SERIAL:
         try:
             print("\rInitiating serial...\n")
@@ -322,7 +465,7 @@ def main():
         
         socket_thread = SocketThread()
         serial_thread = SerialThread(selected_port.device)
-        socket_thread.serial_manager = serial_thread
+        socket_thread.set_serial_manager(serial_thread)
         serial_thread.socket_manager = socket_thread
 
         serial_thread.start()
@@ -335,12 +478,14 @@ def main():
 
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         print(Fore.LIGHTBLACK_EX + f"Connecting to {SERVER_ADDRESS}:{SERVER_PORT} ...")
         sock.connect((SERVER_ADDRESS, SERVER_PORT))
         print(Fore.GREEN + f"Connected to {SERVER_ADDRESS}:{SERVER_PORT} !")
 
         print(Fore.YELLOW + "Logging in..")
-        sock.send("SERIAL_CONNECTED".encode())
+        sock.send(MSG_SERIAL_CONNECTED)
         sock.recv(4096)
 
         sock.send(f"LOGIN:{CALC_ID}:{USERNAME}:{TOKEN}".encode())
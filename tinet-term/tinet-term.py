@@ -10,9 +10,10 @@ init(autoreset=True)
 SERVER_ADDRESS = "tinethub.tkbstudios.com"
 SERVER_PORT = 2052
 
-CALC_ID = dotenv.get_key(key_to_get="CALC_ID", dotenv_path=".env")
-USERNAME = dotenv.get_key(key_to_get="USERNAME", dotenv_path=".env")
-TOKEN = dotenv.get_key(key_to_get="TOKEN", dotenv_path=".env")
+env = dotenv.dotenv_values(".env")
+CALC_ID = env.get("CALC_ID")
+USERNAME = env.get("USERNAME")
+TOKEN = env.get("TOKEN")
 
 if CALC_ID is None or USERNAME is None or TOKEN is None:
     print(Fore.RED + "Calc ID, username or token could not be loaded!")